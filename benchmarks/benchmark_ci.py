@@ -6,22 +6,46 @@ Compares cpp_python parser performance against CPython's ast.parse().
 Usage:
     python benchmark_ci.py --output results.json
     python benchmark_ci.py --output results.json --parser ./cpp_parser.exe
+    python benchmark_ci.py --output results.json --parallel
+    python benchmark_ci.py --output results.json --calibrate
 """
 
 import argparse
 import ast
+import functools
+import hashlib
+import io
+import itertools
 import json
+import logging
+import logging.handlers
+import math
+import multiprocessing as mp
 import os
 import platform
+import queue
+import struct
 import subprocess
 import sys
-import tempfile
 import time
+from collections import defaultdict
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from contextlib import ExitStack, contextmanager
+from dataclasses import asdict, dataclass, replace
 from datetime import datetime
-from statistics import mean, stdev
+from typing import Optional
+
+# Minimum duration of one timed sample with --calibrate (1 ms)
+_CALIBRATION_TARGET_NS = 1_000_000
+
+# Reply from cpp_parser --server for a successful parse
+_STATUS_OK = struct.pack("<I", 0)
+
+# Progress messages; see _progress_logging()
+logger = logging.getLogger("bench")
 
 # Test cases with varying complexity
-TEST_CASES = {
+_RAW_TEST_CASES = {
     "simple_expression": "x = 1 + 2 * 3",
     
     "function_definition": '''
@@ -106,151 +130,448 @@ async def main():
 ''',
 }
 
+# Encoded once at import; both ast.parse() and the parser pipe take bytes
+TEST_CASES = {name: code.encode("utf-8") for name, code in _RAW_TEST_CASES.items()}
+
+
+_FUNCTION_TEMPLATE = '''\
+def function_{i}(a, b, c):
+    """Function number {i}."""
+    result = a + b * c
+    if result > {i}:
+        return result - {i}
+    elif result < -{i}:
+        return result + {i}
+    else:
+        return result
+
+'''
+
+_METHOD_TEMPLATE = '''
+    def method_{i}(self, x):
+        """Method number {i}."""
+        return x * {ip1}
+'''
+
 
 def generate_large_file(num_functions=100):
     """Generate a large Python file for stress testing."""
-    lines = ['"""Auto-generated large Python file for benchmarking."""', '']
-    
-    for i in range(num_functions):
-        lines.extend([
-            f'def function_{i}(a, b, c):',
-            f'    """Function number {i}."""',
-            f'    result = a + b * c',
-            f'    if result > {i}:',
-            f'        return result - {i}',
-            f'    elif result < -{i}:',
-            f'        return result + {i}',
-            f'    else:',
-            f'        return result',
-            '',
-        ])
+    buf = io.StringIO()
+    buf.write('"""Auto-generated large Python file for benchmarking."""\n\n')
+    buf.writelines(_FUNCTION_TEMPLATE.format_map({"i": i}) for i in range(num_functions))
     
     # Add a class
-    lines.extend([
-        'class BenchmarkClass:',
-        '    """A class with many methods."""',
-        '',
-    ])
-    
-    for i in range(20):
-        lines.extend([
-            f'    def method_{i}(self, x):',
-            f'        """Method number {i}."""',
-            f'        return x * {i + 1}',
-            '',
-        ])
-    
-    return '\n'.join(lines)
-
-
-def benchmark_cpython(code: str, iterations: int = 100) -> list:
-    """Benchmark CPython's ast.parse() function."""
-    times = []
+    buf.write('class BenchmarkClass:\n    """A class with many methods."""\n')
+    buf.writelines(_METHOD_TEMPLATE.format_map({"i": i, "ip1": i + 1}) for i in range(20))
+    
+    return buf.getvalue()
+
+
+@functools.lru_cache(maxsize=None)
+def _host_info() -> tuple:
+    """Return (platform, python_version), looked up once per process.
+    
+    platform.platform() may spawn a subprocess on some systems. It is
+    computed lazily so spawned pool workers never pay for it.
+    """
+    return platform.platform(), platform.python_version()
+
+
+def _calibrate_loops(code: bytes, min_time_ns: int = _CALIBRATION_TARGET_NS) -> int:
+    """Pick how many back-to-back ast.parse() calls make one timed sample.
+    
+    Doubles the loop count until a sample lasts at least min_time_ns, so
+    the cost of reading the clock is amortized away for tiny snippets.
+    """
+    loops = 1
+    while True:
+        start = time.perf_counter_ns()
+        for _ in itertools.repeat(None, loops):
+            ast.parse(code)
+        if time.perf_counter_ns() - start >= min_time_ns:
+            return loops
+        loops *= 2
+
+
+def benchmark_cpython(code: bytes, iterations: int = 100, loops: int = 1) -> tuple:
+    """Benchmark CPython's ast.parse() function.
+    
+    Each sample times loops back-to-back calls and records the per-call
+    average; with loops == 1 only the single call is inside the timed
+    region. Returns Welford accumulators (n, mean, m2) over the samples
+    in ms.
+    """
+    n, mean, m2 = 0, 0.0, 0.0
     for _ in range(iterations):
-        start = time.perf_counter()
-        ast.parse(code)
-        end = time.perf_counter()
-        times.append((end - start) * 1000)  # Convert to milliseconds
-    return times
+        if loops == 1:
+            start = time.perf_counter_ns()
+            ast.parse(code)
+            x = time.perf_counter_ns() - start
+        else:
+            start = time.perf_counter_ns()
+            for _ in itertools.repeat(None, loops):
+                ast.parse(code)
+            x = (time.perf_counter_ns() - start) / loops
+        n += 1
+        delta = x - mean
+        mean += delta / n
+        m2 += delta * (x - mean)
+    # Samples are in ns; convert the accumulators to ms once
+    return n, mean / 1e6, m2 / 1e12
 
 
-def benchmark_cpp_parser(code: str, parser_path: str, iterations: int = 100) -> list:
-    """Benchmark the cpp_python parser."""
-    times = []
+def _dedupe_cases(test_cases: dict) -> tuple:
+    """Group test cases whose source is identical by content hash.
     
-    # Write code to a temporary file
-    with tempfile.NamedTemporaryFile(mode='w', suffix='.py', delete=False) as f:
-        f.write(code)
-        temp_path = f.name
+    Returns (unique, aliases, hashes): unique maps the first name seen for
+    each distinct source to its code, aliases maps that name to every name
+    sharing the source (itself included), and hashes maps each name to the
+    hex digest of its source.
+    """
+    by_hash = {}
+    unique = {}
+    aliases = defaultdict(list)
+    hashes = {}
+    for name, code in test_cases.items():
+        digest = hashlib.blake2b(code, digest_size=8).hexdigest()
+        first = by_hash.setdefault(digest, name)
+        if first == name:
+            unique[name] = code
+        aliases[first].append(name)
+        hashes[name] = digest
+    return unique, aliases, hashes
+
+
+def _materialize_cases(test_cases: dict) -> dict:
+    """Build the length-prefixed --server request for each test case once."""
+    frames = {}
+    for name, code in test_cases.items():
+        frames[name] = struct.pack("<I", len(code)) + code
+    return frames
+
+
+def benchmark_cpp_parser(frame: bytes, parser_path: str, iterations: int = 100,
+                         loops: int = 1) -> tuple:
+    """Benchmark the cpp_python parser.
+    
+    The parser is started once in --server mode and each sample times loops
+    round-trips of the prebuilt request frame over its stdin/stdout pipes,
+    so process start-up is not part of the measurement; with loops == 1
+    only the single round-trip is inside the timed region. Returns Welford
+    accumulators (n, mean, m2) over the per-round-trip samples in ms, or
+    None if the parser failed.
+    """
+    n, mean, m2 = 0, 0.0, 0.0
+    
+    proc = subprocess.Popen(
+        [parser_path, "--server"],
+        stdin=subprocess.PIPE,
+        stdout=subprocess.PIPE,
+        stderr=subprocess.DEVNULL,
+        bufsize=0,
+        # Our fds are non-inheritable anyway; skip the per-exec close loop
+        close_fds=os.name != "posix"
+    )
     
     try:
         for _ in range(iterations):
-            start = time.perf_counter()
-            result = subprocess.run(
-                [parser_path, temp_path],
-                capture_output=True,
-                text=True
-            )
-            end = time.perf_counter()
+            try:
+                if loops == 1:
+                    start = time.perf_counter_ns()
+                    proc.stdin.write(frame)
+                    proc.stdin.flush()
+                    reply = proc.stdout.read(4)
+                    x = time.perf_counter_ns() - start
+                else:
+                    start = time.perf_counter_ns()
+                    for _ in itertools.repeat(None, loops):
+                        proc.stdin.write(frame)
+                        proc.stdin.flush()
+                        reply = proc.stdout.read(4)
+                        if reply != _STATUS_OK:
+                            break
+                    x = (time.perf_counter_ns() - start) / loops
+            except (BrokenPipeError, OSError):
+                # Parser exited early (e.g. a build without --server)
+                return None
             
-            if result.returncode != 0:
+            if reply != _STATUS_OK:
                 # Parser failed - return None to indicate failure
                 return None
             
-            times.append((end - start) * 1000)  # Convert to milliseconds
+            n += 1
+            delta = x - mean
+            mean += delta / n
+            m2 += delta * (x - mean)
+    finally:
+        proc.stdin.close()
+        proc.wait()
+    
+    # Samples are in ns; convert the accumulators to ms once
+    return n, mean / 1e6, m2 / 1e12
+
+
+def _diagnose_cpp_parser(frame: bytes, parser_path: str) -> str:
+    """Re-run a failed request untimed, capturing stderr for the error message."""
+    result = subprocess.run(
+        [parser_path, "--server"],
+        input=frame,
+        capture_output=True
+    )
+    # stderr also carries the parser's debug trace; keep only the error lines
+    errors = [line for line in result.stderr.decode("utf-8", "replace").splitlines()
+              if line.startswith("Error:")]
+    return errors[-1] if errors else f"exit code {result.returncode}"
+
+
+def _split_cpus():
+    """Split the CPUs this process may run on into two disjoint sets.
+    
+    Returns None where CPU affinity is not supported or fewer than two
+    CPUs are available. Note that on small machines the two halves may be
+    SMT siblings of one physical core, which gives little isolation.
+    """
+    if not hasattr(os, "sched_getaffinity"):
+        return None
+    cpus = sorted(os.sched_getaffinity(0))
+    if len(cpus) < 2:
+        return None
+    half = len(cpus) // 2
+    return set(cpus[:half]), set(cpus[half:])
+
+
+def _run_pinned(cpus, func, *args):
+    """Call func(*args) with the calling thread pinned to cpus (if given).
+    
+    The previous affinity is restored afterwards. Subprocesses started by
+    func inherit the pinned mask.
+    """
+    if cpus is None:
+        return func(*args)
+    # On Linux, pid 0 targets the calling thread only
+    previous = os.sched_getaffinity(0)
+    os.sched_setaffinity(0, cpus)
+    try:
+        return func(*args)
     finally:
-        os.unlink(temp_path)
+        os.sched_setaffinity(0, previous)
+
+
+@dataclass(slots=True, frozen=True)
+class TestResult:
+    """Timings for one test case, as written to the results JSON."""
+    name: str
+    cpython_mean_ms: float
+    cpython_std_ms: float
+    cpp_mean_ms: float
+    cpp_std_ms: float
+    ratio: float
+    code_lines: int
+    loops: int
+    hash: str = ""
+
+
+def _bench_one(name: str, code: bytes, frame: bytes, parser_path: str, iterations: int,
+               cpython_pool=None, calibrate: bool = False) -> Optional[TestResult]:
+    """Benchmark a single test case; returns None if the parser failed.
+    
+    If cpython_pool (a single-worker process executor) is given, the CPython
+    benchmark runs in that process while cpp_parser is timed here, pinned to
+    disjoint CPU sets where supported. A separate process is needed because
+    ast.parse() holds the GIL for the whole call.
+    With calibrate=True, each sample repeats the parse enough times to
+    last at least _CALIBRATION_TARGET_NS (see _calibrate_loops()).
+    """
+    # Make sure the snippet is valid Python before timing anything
+    ast.parse(code)
+    
+    loops = _calibrate_loops(code) if calibrate else 1
+    
+    if cpython_pool is not None:
+        cpython_cpus, cpp_cpus = _split_cpus() or (None, None)
+        cpython_future = cpython_pool.submit(_run_pinned, cpython_cpus,
+                                             benchmark_cpython, code, iterations, loops)
+        cpp_stats = _run_pinned(cpp_cpus, benchmark_cpp_parser,
+                                frame, parser_path, iterations, loops)
+        cpython_stats = cpython_future.result()
+    else:
+        # Benchmark CPython
+        cpython_stats = benchmark_cpython(code, iterations, loops)
+        
+        # Benchmark cpp_parser
+        cpp_stats = benchmark_cpp_parser(frame, parser_path, iterations, loops)
+    
+    cpython_n, cpython_mean, cpython_m2 = cpython_stats
+    cpython_std = math.sqrt(cpython_m2 / (cpython_n - 1)) if cpython_n > 1 else 0
+    
+    if cpp_stats is None:
+        return None
     
-    return times
+    cpp_n, cpp_mean, cpp_m2 = cpp_stats
+    cpp_std = math.sqrt(cpp_m2 / (cpp_n - 1)) if cpp_n > 1 else 0
+    
+    ratio = cpp_mean / cpython_mean if cpython_mean > 0 else float('inf')
+    
+    return TestResult(
+        name=name,
+        cpython_mean_ms=cpython_mean,
+        cpython_std_ms=cpython_std,
+        cpp_mean_ms=cpp_mean,
+        cpp_std_ms=cpp_std,
+        ratio=ratio,
+        code_lines=code.strip().count(b'\n') + 1,
+        loops=loops
+    )
 
 
-def run_benchmarks(parser_path: str, iterations: int = 50) -> dict:
-    """Run all benchmarks and return results."""
-    results = {
-        "platform": platform.platform(),
-        "python_version": platform.python_version(),
+class _StreamingResultsWriter:
+    """Write the results JSON incrementally, one test entry at a time.
+    
+    The output is the same strict JSON document as a single json.dump()
+    would produce, but each test is written (and flushed) as soon as it
+    finishes so nothing accumulates in memory and CI can tail progress.
+    """
+    
+    def __init__(self, f, header: dict):
+        self.f = f
+        self.count = 0
+        f.write("{\n")
+        for key, value in header.items():
+            f.write(f"  {json.dumps(key)}: {json.dumps(value)},\n")
+        f.write('  "tests": [')
+        f.flush()
+    
+    def add_test(self, test_result: TestResult):
+        self.f.write(",\n    " if self.count else "\n    ")
+        self.f.write(json.dumps(asdict(test_result)))
+        self.f.flush()
+        self.count += 1
+    
+    def close(self, summary: dict):
+        self.f.write("\n  ],\n" if self.count else "],\n")
+        self.f.write(f'  "summary": {json.dumps(summary)}\n}}\n')
+        self.f.flush()
+
+
+@contextmanager
+def _progress_logging():
+    """Route progress messages through a queue drained by one writer thread.
+    
+    Callers only enqueue records, so they never block on (or contend for)
+    stdout; the listener thread does all the writing.
+    """
+    records = queue.Queue()
+    queue_handler = logging.handlers.QueueHandler(records)
+    stream_handler = logging.StreamHandler(sys.stdout)
+    stream_handler.setFormatter(logging.Formatter("%(message)s"))
+    listener = logging.handlers.QueueListener(records, stream_handler)
+    
+    previous_level, previous_propagate = logger.level, logger.propagate
+    logger.addHandler(queue_handler)
+    logger.setLevel(logging.INFO)
+    logger.propagate = False
+    listener.start()
+    try:
+        yield
+    finally:
+        listener.stop()
+        logger.removeHandler(queue_handler)
+        logger.setLevel(previous_level)
+        logger.propagate = previous_propagate
+
+
+def run_benchmarks(parser_path: str, output, iterations: int = 50, parallel: bool = False,
+                   calibrate: bool = False, overlap: bool = False) -> dict:
+    """Run all benchmarks, streaming results to output; returns the summary.
+    
+    With parallel=True, test cases are benchmarked concurrently in a
+    process pool sized to the number of CPUs. With overlap=True (serial
+    runs only), the CPython side of each test case runs in a helper process
+    at the same time as the cpp_parser side.
+    With calibrate=True, each sample is averaged over a calibrated number
+    of back-to-back parses.
+    """
+    host_platform, python_version = _host_info()
+    writer = _StreamingResultsWriter(output, {
+        "platform": host_platform,
+        "python_version": python_version,
         "timestamp": datetime.utcnow().isoformat(),
         "iterations": iterations,
-        "tests": [],
-        "summary": {}
-    }
+        "calibrate": calibrate,
+        "overlap": overlap,
+    })
     
     # Add large file test case
     test_cases = dict(TEST_CASES)
-    test_cases["large_file"] = generate_large_file(50)
+    test_cases["large_file"] = generate_large_file(50).encode("utf-8")
+    
+    # Only benchmark each distinct source once; aliases reuse its result
+    unique, aliases, hashes = _dedupe_cases(test_cases)
+    frames = _materialize_cases(unique)
     
     ratios = []
     
-    for name, code in test_cases.items():
-        print(f"Benchmarking: {name}...", end=" ", flush=True)
-        
-        # Benchmark CPython
-        cpython_times = benchmark_cpython(code, iterations)
-        cpython_mean = mean(cpython_times)
-        cpython_std = stdev(cpython_times) if len(cpython_times) > 1 else 0
-        
-        # Benchmark cpp_parser
-        cpp_times = benchmark_cpp_parser(code, parser_path, iterations)
-        
-        if cpp_times is None:
-            print("SKIP (parser failed)")
-            continue
-        
-        cpp_mean = mean(cpp_times)
-        cpp_std = stdev(cpp_times) if len(cpp_times) > 1 else 0
-        
-        ratio = cpp_mean / cpython_mean if cpython_mean > 0 else float('inf')
-        ratios.append(ratio)
-        
-        test_result = {
-            "name": name,
-            "cpython_mean_ms": cpython_mean,
-            "cpython_std_ms": cpython_std,
-            "cpp_mean_ms": cpp_mean,
-            "cpp_std_ms": cpp_std,
-            "ratio": ratio,
-            "code_lines": len(code.strip().split('\n'))
-        }
-        
-        results["tests"].append(test_result)
-        print(f"done (ratio: {ratio:.2f}x)")
-    
-    # Calculate summary
-    if ratios:
-        avg_ratio = mean(ratios)
-        if avg_ratio < 1:
-            comparison = f"{1/avg_ratio:.2f}x faster than CPython"
+    def report(name, test_result):
+        if test_result is None:
+            reason = _diagnose_cpp_parser(frames[name], parser_path)
+            logger.info(f"{name}: SKIP (parser failed: {reason})")
+            return
+        for alias in aliases[name]:
+            row = replace(test_result, name=alias, hash=hashes[alias])
+            ratios.append(row.ratio)
+            writer.add_test(row)
+        logger.info(f"{name}: done (ratio: {test_result.ratio:.2f}x)")
+    
+    # Always terminate the JSON document, even if a benchmark raises
+    summary = {}
+    mp_context = mp.get_context("spawn") if sys.platform == "win32" else None
+    try:
+        # Pool workers are started before the logging listener thread, so
+        # that forked children never inherit a running listener
+        if parallel:
+            # Each test case is independent, so fan them out across cores
+            workers = min(len(unique), os.cpu_count() or 1)
+            print(f"Parallel: {workers} workers")
+            with ProcessPoolExecutor(max_workers=workers, mp_context=mp_context) as pool:
+                futures = {
+                    pool.submit(_bench_one, name, code, frames[name], parser_path, iterations,
+                                calibrate=calibrate): name
+                    for name, code in unique.items()
+                }
+                with _progress_logging():
+                    for future in as_completed(futures):
+                        report(futures[future], future.result())
         else:
-            comparison = f"{avg_ratio:.2f}x slower than CPython"
+            with ExitStack() as stack:
+                cpython_pool = None
+                if overlap:
+                    cpython_pool = stack.enter_context(
+                        ProcessPoolExecutor(max_workers=1, mp_context=mp_context))
+                    cpython_pool.submit(int).result()  # start the worker now
+                stack.enter_context(_progress_logging())
+                for name, code in unique.items():
+                    # Logged up front so a hung parser pipe shows which case is stuck
+                    logger.info(f"Benchmarking: {name}...")
+                    report(name, _bench_one(name, code, frames[name], parser_path, iterations,
+                                            cpython_pool, calibrate))
         
-        results["summary"] = {
-            "average_ratio": avg_ratio,
-            "min_ratio": min(ratios),
-            "max_ratio": max(ratios),
-            "comparison": comparison
-        }
-    
-    return results
+        # Calculate summary
+        if ratios:
+            avg_ratio = sum(ratios) / len(ratios)
+            if avg_ratio < 1:
+                comparison = f"{1/avg_ratio:.2f}x faster than CPython"
+            else:
+                comparison = f"{avg_ratio:.2f}x slower than CPython"
+        
+            summary = {
+                "average_ratio": avg_ratio,
+                "min_ratio": min(ratios),
+                "max_ratio": max(ratios),
+                "comparison": comparison
+            }
+    finally:
+        writer.close(summary)
+    return summary
 
 
 def main():
@@ -261,8 +582,20 @@ def main():
                         help="Path to cpp_parser executable")
     parser.add_argument("--iterations", "-i", type=int, default=50,
                         help="Number of iterations per test")
+    concurrency = parser.add_mutually_exclusive_group()
+    concurrency.add_argument("--parallel", "-j", action="store_true",
+                             help="Benchmark test cases concurrently across CPU cores")
+    concurrency.add_argument("--overlap", action="store_true",
+                             help="Run the CPython and cpp_parser sides of each test "
+                                  "concurrently (timings are noisier)")
+    parser.add_argument("--calibrate", action="store_true",
+                        help="Average each sample over enough back-to-back parses "
+                             "to last at least 1 ms")
     
     args = parser.parse_args()
+    if args.iterations < 1:
+        # Mean and standard deviation need at least one sample
+        parser.error("--iterations must be at least 1")
     
     # Check if parser exists
     if not os.path.exists(args.parser):
@@ -271,19 +604,19 @@ def main():
     
     print(f"Running benchmarks with {args.iterations} iterations...")
     print(f"Parser: {args.parser}")
-    print(f"Platform: {platform.platform()}")
-    print(f"Python: {platform.python_version()}")
+    host_platform, python_version = _host_info()
+    print(f"Platform: {host_platform}")
+    print(f"Python: {python_version}")
     print()
     
-    results = run_benchmarks(args.parser, args.iterations)
-    
-    # Write results to JSON
+    # Results are streamed to the JSON file as each test completes
     with open(args.output, 'w') as f:
-        json.dump(results, f, indent=2)
+        summary = run_benchmarks(args.parser, f, args.iterations, args.parallel,
+                                 args.calibrate, args.overlap)
     
     print()
     print(f"Results written to: {args.output}")
-    print(f"Summary: cpp_parser is {results['summary'].get('comparison', 'N/A')}")
+    print(f"Summary: cpp_parser is {summary.get('comparison', 'N/A')}")
 
 
 if __name__ == "__main__":
@@ -1,16 +1,74 @@
+#include <cstdint>
+#include <cstdio>
+#include <cstring>
 #include <iostream>
 #include <fstream>
 #include <sstream>
+#ifdef _WIN32
+#include <fcntl.h>
+#include <io.h>
+#endif
 #include "src/parser/parser.hpp"
 #include "src/compiler/compiler.hpp"
 
+// Server mode: parse sources streamed over stdin without restarting the process.
+// Each request is {u32 length}{length bytes of source}; each reply is {u32 status},
+// 0 on success and 1 on parse error. Integers are little-endian. Exits on EOF.
+static bool read_exact(char* data, size_t size) {
+    return std::fread(data, 1, size, stdin) == size;
+}
+
+static int run_server() {
+#ifdef _WIN32
+    _setmode(_fileno(stdin), _O_BINARY);
+    _setmode(_fileno(stdout), _O_BINARY);
+#endif
+    unsigned char header[4];
+    std::string source_code;
+    while (read_exact(reinterpret_cast<char*>(header), sizeof(header))) {
+        uint32_t length = static_cast<uint32_t>(header[0]) |
+                          (static_cast<uint32_t>(header[1]) << 8) |
+                          (static_cast<uint32_t>(header[2]) << 16) |
+                          (static_cast<uint32_t>(header[3]) << 24);
+        source_code.resize(length);
+        if (length > 0 && !read_exact(&source_code[0], length)) {
+            std::cerr << "Error: Truncated request" << std::endl;
+            return 1;
+        }
+
+        uint32_t status = 0;
+        try {
+            cpython_cpp::parser::Parser parser(source_code);
+            parser.parse();
+        } catch (const std::exception& e) {
+            std::cerr << "Error: " << e.what() << std::endl;
+            status = 1;
+        }
+
+        unsigned char reply[4] = {
+            static_cast<unsigned char>(status & 0xFF),
+            static_cast<unsigned char>((status >> 8) & 0xFF),
+            static_cast<unsigned char>((status >> 16) & 0xFF),
+            static_cast<unsigned char>((status >> 24) & 0xFF),
+        };
+        std::fwrite(reply, 1, sizeof(reply), stdout);
+        std::fflush(stdout);
+    }
+    return 0;
+}
+
 int main(int argc, char* argv[]) {
+    if (argc >= 2 && std::strcmp(argv[1], "--server") == 0) {
+        return run_server();
+    }
+
     std::cout << "CPython C++ Parser and Compiler\n";
     std::cout << "===============================\n\n";
 
     if (argc < 2) {
         std::cerr << "Error: No file provided" << std::endl;
         std::cerr << "Usage: " << argv[0] << " <python_script.py>" << std::endl;
+        std::cerr << "       " << argv[0] << " --server" << std::endl;
         return 1;
     }
 